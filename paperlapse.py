@@ -1,13 +1,21 @@
+import bisect
+import hashlib
 import math
+import os
 import shutil
 import subprocess
-from datetime import datetime, timedelta
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
 from pathlib import Path
-from typing import Literal
+from typing import Literal, NamedTuple
 
+import fitz
 import git
+import pygit2
 import pytz
-from icecream import ic
+from PIL import Image
 from tqdm import tqdm
 
 # ------- INPUTS ------------------------------------
@@ -45,86 +53,287 @@ timing = "days"
 # Must have timezone information
 start_datetime = datetime(2022, 12, 7, tzinfo=pytz.timezone("Europe/Berlin"))
 
+# Number of LaTeX projects to compile in parallel (defaults to the number of CPU
+# cores). LaTeX itself is single-threaded, so compiling multiple commits at the same
+# time is the only way to keep all cores busy.
+num_workers = os.cpu_count()
+
+# Restrict the compile worktrees to these git sparse-checkout patterns, e.g.
+# ["*.tex", "*.bib", "*.sty", "figures/"]. Useful when the repo also hosts large files
+# (raw data, measurement results) that the LaTeX project never reads. Set to None to
+# check out the full tree.
+sparse_checkout_paths = None
+
+# Write the intermediate PNGs with OpenCV instead of Pillow. OpenCV's PNG encoder is
+# noticeably faster, but requires opencv-python and numpy to be installed.
+use_cv2 = False
+
+if use_cv2:
+    import cv2
+    import numpy as np
+
+
+class Commit(NamedTuple):
+    """
+    Lightweight stand-in for a full GitPython commit object, carrying only the fields
+    the pipeline actually reads.
+    """
+
+    hexsha: str
+    tree_hexsha: str
+    committed_datetime: datetime
+
+
+def list_commits(repo_dir: Path, branch: str) -> list:
+    """
+    List the commits on `branch` from oldest to newest with a single git log call,
+    instead of having GitPython construct a full commit object per commit.
+    """
+    log = subprocess.run(
+        [
+            "git",
+            "-C",
+            str(repo_dir),
+            "log",
+            "--reverse",
+            "--first-parent",
+            "--format=%H %T %ct",
+            branch,
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+    commits = []
+    for line in log.splitlines():
+        hexsha, tree_hexsha, timestamp = line.split()
+        commits.append(
+            Commit(
+                hexsha,
+                tree_hexsha,
+                datetime.fromtimestamp(int(timestamp), tz=timezone.utc),
+            )
+        )
+    return commits
+
+
+# Worktree directory and pygit2 repository of the current worker process, set by
+# `setup_worktree`
+worktree_dir = None
+worktree_repo = None
+
+# Hash of the preamble that this worker's precompiled format file was built from
+preamble_fmt_hash = None
+
+
+def setup_worktree(repo_dir: Path, worktree_root: Path) -> None:
+    """Create a dedicated git worktree for this worker process to compile in."""
+    global worktree_dir, worktree_repo
+
+    worktree_dir = worktree_root / f"worker-{os.getpid()}"
+    subprocess.run(
+        ["git", "worktree", "add", "--detach", str(worktree_dir)],
+        cwd=repo_dir,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    if sparse_checkout_paths is not None:
+        subprocess.run(
+            ["git", "sparse-checkout", "set", "--no-cone"] + sparse_checkout_paths,
+            cwd=worktree_dir,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    worktree_repo = pygit2.Repository(str(worktree_dir))
+
+
+def hash_preamble() -> str:
+    """Hash the paper's preamble and local class and style files in this worktree."""
+    hasher = hashlib.blake2s()
+    tex_source = (worktree_dir / f"{paper_name}.tex").read_bytes()
+    hasher.update(tex_source.split(rb"\begin{document}")[0])
+    for path in sorted(worktree_dir.glob("*.cls")) + sorted(worktree_dir.glob("*.sty")):
+        hasher.update(path.read_bytes())
+    return hasher.hexdigest()
+
+
+def precompile_preamble() -> bool:
+    """
+    Precompile the paper's preamble into a pdflatex format file via mylatexformat, so
+    that subsequent pdflatex passes skip tokenising the package loading.
+
+    Returns whether precompilation succeeded.
+    """
+    try:
+        subprocess.run(
+            [
+                "pdftex",
+                "-ini",
+                "-interaction=nonstopmode",
+                f"-jobname={paper_name}",
+                "&pdflatex",
+                "mylatexformat.ltx",
+                f"{paper_name}.tex",
+            ],
+            cwd=worktree_dir,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return True
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        # FileNotFoundError covers a missing pdftex binary
+        return False
+
+
+def compile_commit(hexsha: str, output_filename: Path) -> bool:
+    """
+    Compile the LaTeX project at a single commit in this worker's worktree and move the
+    resulting PDF to `output_filename`.
+
+    Returns whether the commit compiled successfully.
+    """
+    global preamble_fmt_hash
+
+    if sparse_checkout_paths is None:
+        # Check out the commit in-process through libgit2 instead of spawning a git
+        # subprocess per commit
+        commit_object = worktree_repo.get(hexsha)
+        worktree_repo.checkout_tree(commit_object, strategy=pygit2.GIT_CHECKOUT_FORCE)
+        worktree_repo.set_head(commit_object.id)
+    else:
+        # libgit2 doesn't implement sparse checkout, so go through git itself whenever
+        # sparse patterns are configured
+        subprocess.run(
+            ["git", "checkout", "--detach", "--force", hexsha],
+            cwd=worktree_dir,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    try:
+        # The preamble rarely changes between commits but dominates pdflatex startup,
+        # so it is precompiled into a format file that is only rebuilt when the
+        # preamble or a local class or style file changes
+        current_preamble_hash = hash_preamble()
+        if current_preamble_hash != preamble_fmt_hash:
+            if not precompile_preamble():
+                (worktree_dir / f"{paper_name}.fmt").unlink(missing_ok=True)
+            preamble_fmt_hash = current_preamble_hash
+
+        latexmk_command = [
+            "latexmk",
+            "-pdf",
+            "-synctex=1",
+            "-interaction=nonstopmode",
+            "-halt-on-error",
+        ]
+        if (worktree_dir / f"{paper_name}.fmt").exists():
+            # Have latexmk's pdflatex passes start from the precompiled preamble
+            latexmk_command.append(f"-pdflatex=pdflatex -fmt={paper_name} %O %S")
+        latexmk_command.append(f"{paper_name}.tex")
+
+        # Compile tex with references. latexmk reruns pdflatex and bibtex only until
+        # the aux files reach a fixed point, rather than a hard-coded number of passes.
+        # The aux files of previous compiles survive the checkout because they are
+        # untracked, so latexmk often converges in a single pass for small edits.
+        subprocess.run(
+            latexmk_command,
+            cwd=worktree_dir,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        # Move generated pdf to output folder
+        shutil.move(worktree_dir / f"{paper_name}.pdf", output_filename)
+
+        return True
+
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        # A commit without the paper file (e.g. an initial README-only commit) or a
+        # compile that exits cleanly without producing the expected PDF is treated as
+        # a failure just like a failed compile
+        return False
+
 
 def generate_pdfs(commits: list, repo: git.Repo, pdf_dir: Path) -> list:
     """
-    Generate PDFs by looping through all past commits on the brange and rendering the
-    LaTeX project.
+    Generate PDFs by rendering the LaTeX project for all past commits on the branch.
+    Commits are compiled in parallel, each in its own git worktree so that checkouts
+    don't collide.
 
     Returns a list of commits that compiled successfully.
     """
     pdf_dir.mkdir(parents=True, exist_ok=True)
 
-    last_commit = commits[-1]
-
-    successful_commits = []
-    for commit in tqdm(commits, desc="Generating PDFs ..."):
-        output_filename = pdf_dir / f"{commit.hexsha}.pdf"
-
-        # Check that file doesn't already exist
-        if output_filename.exists():
-            successful_commits.append(commit)
-            continue
-
-        # Check out old commit
-        repo.git.checkout(commit)
-
-        try:
-            # Compile tex with references
-            repo.git.execute(
-                [
-                    "pdflatex",
-                    "-synctex=1",
-                    "-interaction=nonstopmode",
-                    f"{paper_name}.tex",
-                ]
+    # Place the worktrees on a RAM-backed tmpfs when the system has one, so that
+    # pdflatex's many small synchronous aux file writes never touch the disk. Only the
+    # finished PDFs are moved to the output folder.
+    if Path("/dev/shm").is_dir():
+        worktree_root = Path(tempfile.mkdtemp(prefix="paperlapse-", dir="/dev/shm"))
+    else:
+        worktree_root = pdf_dir.parent / "worktrees"
+        worktree_root.mkdir(parents=True, exist_ok=True)
+
+    # PDFs are cached by the hash of the commit's source tree rather than the commit
+    # hash itself, so commits with identical trees (merges, empty commits, rewritten
+    # history) share a single compile and a single file on disk
+    pending_trees = {}
+    for commit in commits:
+        if not (pdf_dir / f"{commit.tree_hexsha}.pdf").exists():
+            pending_trees.setdefault(commit.tree_hexsha, commit)
+
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=setup_worktree,
+        initargs=(input_dir, worktree_root),
+    ) as executor:
+        futures = {
+            tree_hexsha: executor.submit(
+                compile_commit, commit.hexsha, pdf_dir / f"{tree_hexsha}.pdf"
             )
-            repo.git.execute(["bibtex", f"{paper_name}.aux"])
-            repo.git.execute(
-                [
-                    "pdflatex",
-                    "-synctex=1",
-                    "-interaction=nonstopmode",
-                    f"{paper_name}.tex",
-                ]
-            )
-            repo.git.execute(["bibtex", f"{paper_name}.aux"])
-            repo.git.execute(
-                [
-                    "pdflatex",
-                    "-synctex=1",
-                    "-interaction=nonstopmode",
-                    f"{paper_name}.tex",
-                ]
-            )
-
-            # Move generated pdf to output folder
-            (input_dir / f"{paper_name}.pdf").rename(output_filename)
-
-            successful_commits.append(commit)
+            for tree_hexsha, commit in pending_trees.items()
+        }
+
+        successful_commits = []
+        for commit in tqdm(commits, desc="Generating PDFs ..."):
+            tree_hexsha = commit.tree_hexsha
+            if tree_hexsha not in futures or futures[tree_hexsha].result():
+                successful_commits.append(commit)
+            else:
+                print(
+                    f"   ... skipping commit {commit.hexsha} because it failed to"
+                    " compile."
+                )
+
+    # Tear down the worktrees now that all compiles have finished
+    for worktree in worktree_root.glob("worker-*"):
+        repo.git.worktree("remove", "--force", str(worktree))
+    worktree_root.rmdir()
 
-        except git.GitCommandError:
-            print(
-                f"   ... skipping commit {commit.hexsha} because it failed to compile."
-            )
+    return successful_commits
 
-    # Revert back to last commit
-    repo.git.checkout(last_commit)
 
-    return successful_commits
+def count_pages(pdf: Path) -> int:
+    """Count the pages of a PDF by parsing only its trailer, not the page contents."""
+    with fitz.open(pdf) as document:
+        return document.page_count
 
 
 def find_maximum_number_of_pages(pdf_dir: Path) -> int:
     """Find maximum number of pages in the generated PDFs."""
     print("Finding maximum number of pages ...", end=" ")
-    max_page_num = 0
-    for pdf in pdf_dir.glob("*.pdf"):
-        pages = subprocess.run(
-            ["pdfinfo", pdf], stdout=subprocess.PIPE, text=True
-        ).stdout.split("\n")
-        pages = [int(page.split()[1]) for page in pages if page.startswith("Pages")][0]
-        if pages > max_page_num:
-            max_page_num = pages
+
+    # Counting pages is dominated by file IO, so overlapping the reads with threads
+    # collapses this phase to roughly the latency of the slowest file
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        page_counts = executor.map(count_pages, pdf_dir.glob("*.pdf"))
+        max_page_num = max(page_counts, default=0)
 
     print(f"{max_page_num}")
 
@@ -158,6 +367,48 @@ def compute_tile_sizes(total_width: int, total_height: int, max_page_num: int) -
     return grid_width, grid_height, tile_width, tile_height
 
 
+def render_image(
+    input_pdf_file: Path,
+    image_dir: Path,
+    grid_width: int,
+    tile_width: float,
+    tile_height: float,
+) -> None:
+    """Rasterise the pages of a single PDF into a grid-tiled PNG image."""
+    output_png_file = image_dir / f"{input_pdf_file.stem}.png"
+
+    # Check if image already exists
+    if output_png_file.exists():
+        return
+
+    # Rasterise each page at exactly the tile size and paste it onto the canvas. All
+    # pages of a paper share the same size, so the scaling matrix is computed once per
+    # document rather than once per page.
+    canvas = Image.new("RGB", (total_width, total_height), "white")
+    document = fitz.open(input_pdf_file)
+    first_page_rect = document[0].rect
+    matrix = fitz.Matrix(
+        tile_width / first_page_rect.width, tile_height / first_page_rect.height
+    )
+    for i, page in enumerate(document):
+        pixmap = page.get_pixmap(matrix=matrix, alpha=False, colorspace=fitz.csRGB)
+        page_image = Image.frombytes(
+            "RGB", (pixmap.width, pixmap.height), pixmap.samples
+        )
+        row, column = divmod(i, grid_width)
+        canvas.paste(
+            page_image, (round(column * tile_width), round(row * tile_height))
+        )
+
+    # The PNGs are intermediate files, so cheap compression is good enough
+    if use_cv2:
+        # OpenCV expects BGR channel order
+        array = cv2.cvtColor(np.asarray(canvas), cv2.COLOR_RGB2BGR)
+        cv2.imwrite(str(output_png_file), array, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    else:
+        canvas.save(output_png_file, optimize=False, compress_level=1)
+
+
 def generate_images(
     pdf_dir: Path,
     image_dir: Path,
@@ -166,54 +417,32 @@ def generate_images(
     tile_width: float,
     tile_height: float,
 ) -> None:
-    """Generate images from PDFs."""
+    """Generate images from PDFs by rasterising their pages into a grid of tiles."""
     image_dir.mkdir(parents=True, exist_ok=True)
 
-    for input_pdf_file in tqdm(
-        list(pdf_dir.glob("*.pdf")), desc="Generating images ..."
-    ):
-        output_png_file = image_dir / f"{input_pdf_file.stem}.png"
-
-        # Check if image already exists
-        if output_png_file.exists():
-            continue
-
-        # Generate image if it does not exist
-        subprocess.run(
-            [
-                "montage",
-                input_pdf_file,
-                "-tile",
-                f"{grid_width}x{grid_height}",
-                "-background",
-                "white",
-                "-geometry",
-                f"{tile_width}x{tile_height}",
-                "-alpha",
-                "remove",
-                "-colorspace",
-                "sRGB",
-                output_png_file,
-            ]
+    # Rasterisation is pure CPU work and independent per PDF, so render in parallel
+    input_pdf_files = list(pdf_dir.glob("*.pdf"))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        jobs = executor.map(
+            partial(
+                render_image,
+                image_dir=image_dir,
+                grid_width=grid_width,
+                tile_width=tile_width,
+                tile_height=tile_height,
+            ),
+            input_pdf_files,
         )
+        for _ in tqdm(jobs, desc="Generating images ...", total=len(input_pdf_files)):
+            pass
 
 
-def arrange_images(
-    mode: Literal["commits", "days", "realtime"],
-    commits: list,
-    image_dir: Path,
-    arranged_dir: Path,
-) -> None:
-    """Create a directory with images named with frame indices."""
-    arranged_dir.mkdir(parents=True, exist_ok=True)
-
+def order_frames(
+    mode: Literal["commits", "days", "realtime"], commits: list, image_dir: Path
+) -> list:
+    """Determine the ordered list of tile images that make up the movie's frames."""
     if mode == "commits":
-        for i, commit in enumerate(
-            tqdm(commits, desc="Arranging images by commits ...")
-        ):
-            input_image = image_dir / f"{commit.hexsha}.png"
-            output_image = arranged_dir / f"{i:03d}.png"
-            shutil.copy(input_image, output_image)
+        return [image_dir / f"{commit.tree_hexsha}.png" for commit in commits]
 
     elif mode == "days":
         commit_days = [commit.committed_datetime.date() for commit in commits]
@@ -225,26 +454,27 @@ def arrange_images(
         while days[-1] < last_day:
             days.append(days[-1] + timedelta(days=1))
 
-        for i, day in enumerate(tqdm(days, desc="Arranging images by days ...")):
-            # Find the latest commit before the end of the day
-            for commit in reversed(commits):
-                if commit.committed_datetime.date() <= day:
-                    break
+        # Commits are sorted by date, so the latest commit at the end of each day is
+        # found by bisecting the precomputed commit days
+        frame_images = []
+        for day in days:
+            commit_index = bisect.bisect_right(commit_days, day) - 1
+            frame_images.append(
+                image_dir / f"{commits[commit_index].tree_hexsha}.png"
+            )
 
-            input_image = image_dir / f"{commit.hexsha}.png"
-            output_image = arranged_dir / f"{i:03d}.png"
-            shutil.copy(input_image, output_image)
+        return frame_images
 
     elif mode == "realtime":
         commit_times = [commit.committed_datetime for commit in commits]
         time_deltas = [
             commit_times[i] - commit_times[i - 1] for i in range(1, len(commits))
         ]
-        ic(time_deltas)
         target_resolution = min(time_deltas)
-        ic(
-            target_resolution,
-            (max(commit_times) - min(commit_times)) / target_resolution,
+        num_frames = (max(commit_times) - min(commit_times)) / target_resolution
+        print(
+            f"Realtime mode would require {num_frames:.0f} frames at a resolution of"
+            f" {target_resolution} and is currently disabled."
         )
         exit()
 
@@ -252,47 +482,180 @@ def arrange_images(
         while frame_times[-1] < commit_times[-1]:
             frame_times.append(frame_times[-1] + target_resolution)
 
-        for i, frame_time in enumerate(
-            tqdm(frame_times, desc="Arranging images by realtime ...")
-        ):
-            # Find the latest commit before the end of the day
-            for commit in reversed(commits):
-                if commit.committed_datetime <= frame_time:
-                    break
+        # Same bisection scheme as in "days" mode, over full datetimes
+        frame_images = []
+        for frame_time in frame_times:
+            commit_index = bisect.bisect_right(commit_times, frame_time) - 1
+            frame_images.append(
+                image_dir / f"{commits[commit_index].tree_hexsha}.png"
+            )
 
-            input_image = image_dir / f"{commit.hexsha}.png"
-            output_image = arranged_dir / f"{i:03d}.png"
-            shutil.copy(input_image, output_image)
+        return frame_images
 
 
-def render_movie(image_dir: Path, output_filename: Path) -> None:
-    """Render movie from images."""
-    print("Rendering movie ...")
-    subprocess.run(
+def build_encoder_arguments(encoder: str) -> list:
+    """Build the ffmpeg output arguments for encoding H.264 with `encoder`."""
+    if encoder == "h264_nvenc":
+        return [
+            "-pix_fmt",
+            "yuv420p",
+            "-c:v",
+            "h264_nvenc",
+            "-preset",
+            "p4",
+            "-rc",
+            "vbr",
+            "-b:v",
+            "8000k",
+        ]
+    elif encoder == "h264_videotoolbox":
+        return [
+            "-pix_fmt",
+            "yuv420p",
+            "-c:v",
+            "h264_videotoolbox",
+            "-b:v",
+            "8000k",
+        ]
+    elif encoder == "h264_vaapi":
+        return [
+            "-vaapi_device",
+            "/dev/dri/renderD128",
+            "-vf",
+            "format=nv12,hwupload",
+            "-c:v",
+            "h264_vaapi",
+            "-b:v",
+            "8000k",
+        ]
+    else:
+        # The frames are near-static text, so x264's expensive analysis buys little;
+        # a fast preset with stillimage tuning and long GOPs is a much better match.
+        # CRF rate control spends bits where the text needs them instead of holding a
+        # fixed bitrate.
+        return [
+            "-pix_fmt",
+            "yuv420p",
+            "-c:v",
+            "libx264",
+            "-preset",
+            "superfast",
+            "-tune",
+            "stillimage",
+            "-threads",
+            "0",
+            "-g",
+            f"{fps * 10}",
+            "-crf",
+            "20",
+        ]
+
+
+def test_encoder(encoder: str) -> bool:
+    """Test whether `encoder` can actually encode by rendering a single black frame."""
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "color=black:size=128x128",
+            "-frames:v",
+            "1",
+        ]
+        + build_encoder_arguments(encoder)
+        + ["-f", "null", "-"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return result.returncode == 0
+
+
+def find_h264_encoder() -> str:
+    """
+    Find the best available H.264 encoder in the local ffmpeg install, preferring
+    hardware encoders over the software libx264 fallback. ffmpeg lists every encoder
+    it was built with, even those whose hardware is absent on this machine, so each
+    candidate is verified with a tiny test encode before it is chosen.
+    """
+    available_encoders = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True
+    ).stdout
+    for encoder in ["h264_nvenc", "h264_videotoolbox", "h264_vaapi"]:
+        if encoder in available_encoders and test_encoder(encoder):
+            return encoder
+    return "libx264"
+
+
+def render_movie(frame_images: list, output_filename: Path) -> None:
+    """Render movie by streaming raw frames into ffmpeg's stdin."""
+    encoder = find_h264_encoder()
+    print(f"Rendering movie with {encoder} ...")
+
+    encoder_arguments = build_encoder_arguments(encoder)
+
+    # With OpenCV available, the RGB to yuv420p conversion happens in its
+    # SIMD-optimised converter before piping, instead of in ffmpeg's swscale
+    input_pixel_format = "yuv420p" if use_cv2 else "rgb24"
+
+    ffmpeg_process = subprocess.Popen(
         [
             "ffmpeg",
             "-hide_banner",
             "-loglevel",
             "error",
             "-y",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            input_pixel_format,
+            "-s",
+            f"{total_width}x{total_height}",
             "-r",
             f"{fps}",
             "-i",
-            f"{image_dir / '%03d.png'}",
-            "-pix_fmt",
-            "yuv420p",
-            "-b",
-            "8000k",
-            "-vcodec",
-            "libx264",
-            f"{output_filename}.mp4",
+            "-",
         ]
+        # +faststart moves the moov atom to the front so playback can start instantly
+        + encoder_arguments
+        + ["-movflags", "+faststart", f"{output_filename}.mp4"],
+        stdin=subprocess.PIPE,
     )
 
+    # Consecutive frames repeat whenever nothing was committed, so an image is only
+    # decoded when it changes from the previous frame
+    previous_image = None
+    try:
+        for frame_image in tqdm(frame_images, desc="Rendering movie ..."):
+            if frame_image != previous_image:
+                frame = Image.open(frame_image).convert("RGB")
+                if use_cv2:
+                    frame_bytes = cv2.cvtColor(
+                        np.asarray(frame), cv2.COLOR_RGB2YUV_I420
+                    ).tobytes()
+                else:
+                    frame_bytes = frame.tobytes()
+                previous_image = frame_image
+            ffmpeg_process.stdin.write(frame_bytes)
+
+        ffmpeg_process.stdin.close()
+    except BrokenPipeError:
+        # ffmpeg died mid-stream; fall through to the exit code check below
+        pass
+
+    return_code = ffmpeg_process.wait()
+    if return_code != 0:
+        raise RuntimeError(
+            f"ffmpeg exited with code {return_code} while rendering the movie."
+        )
+
 
 def main():
     repo = git.Repo(input_dir)
-    commits = list(reversed(list(repo.iter_commits(branch))))
+    commits = list_commits(input_dir, branch)
 
     # If start_datetime is set, filter out commits before that date
     if start_datetime:
@@ -313,13 +676,8 @@ def main():
         tile_width,
         tile_height,
     )
-    arrange_images(
-        timing, successful_commits, output_dir / "images", output_dir / "arranged"
-    )
-    render_movie(output_dir / "arranged", output_dir / paper_name)
-
-    print("Movie rendered, cleaning up ... or not")
-    # (output_dir / "arranged").unlink()
+    frame_images = order_frames(timing, successful_commits, output_dir / "images")
+    render_movie(frame_images, output_dir / paper_name)
 
     print(f"Movie available at {output_dir / paper_name}.mp4")
 